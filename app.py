@@ -1,128 +1,299 @@
 #streamlit app
 import streamlit as st
-from langchain_core.messages import HumanMessage, ToolMessage, BaseMessage
-from langchain_core.tools import tool
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage, BaseMessage
+from langchain_core.tools import StructuredTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langchain_core.caches import InMemoryCache
+from langchain_core.globals import set_llm_cache
 from langgraph.graph import MessagesState, START, END, StateGraph
 from langgraph.prebuilt import tools_condition, ToolNode
 from langchain_groq import ChatGroq
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+import aiosqlite
+import asyncio
 import datetime
+import pathlib
+import queue
+import re
+import threading
+import uuid
+from dataclasses import dataclass
+
+# Response templates
+RETURN_TOO_LATE = (
+    "Return cannot be initiated for order {order_id} as it has been"
+    " more than 10 days since shipping."
+)
+RETURN_OK = (
+    "Return initiated for order {order_id} due to: {reason}. Price after"
+    " penalty is {price:.2f}$."
+)
+RETURN_ALREADY_INITIATED = "A return has already been initiated for order {order_id}."
+CANCEL_OK = (
+    "Return cancellation initiated for order {order_id} due to:"
+    " {reason}. Price reset to {price:.2f}$."
+)
+CANCEL_NOT_INITIATED = (
+    "Order {order_id} is not in 'Return Initiated' status. Cannot"
+    " cancel return."
+)
+
+
+# Order record
+@dataclass(slots=True)
+class OrderRecord:
+    status: str
+    price: float
+    shipped: datetime.date
+    original_price: float
+    previous_status: str | None = None
+
 
 # OrderStatusManager class (as provided before)
 class OrderStatusManager:
+    __slots__ = ("orders",)
+
     def __init__(self):
-        self.order_statuses = {
-            "12345": "Shipped",
-            "67890": "Processing",
-            "11223": "Delivered",
+        self.orders = {
+            "12345": OrderRecord("Shipped", 500.0, datetime.date(2025, 2, 22), 500.0),
+            "67890": OrderRecord("Processing", 79.0, datetime.date(2025, 2, 24), 79.0),
+            "11223": OrderRecord("Delivered", 900.0, datetime.date(2025, 2, 2), 900.0),
         }
-        self.order_price = {
-            "12345": "500$",
-            "67890": "79$",
-            "11223": "900$",
-        }
-        self.order_shipped = {
-            "12345": "22/2/25",
-            "67890": "24/2/25",
-            "11223": "2/2/25",
-        }
-        self.original_prices = self.order_price.copy()
 
     def get_total_price(self, order_id: str) -> str:
         """Calculates total sum  price for an order"""
-        return self.order_price.get(order_id, "total sum price")
+        rec = self.orders.get(order_id)
+        if rec is None:
+            return "total sum price"
+        return f"{rec.price:.2f}$"
 
     def get_order_status(self, order_id: str) -> str:
         """Fetches the status of a given order ID."""
-        return self.order_statuses.get(order_id, "Order ID not found.")
+        rec = self.orders.get(order_id)
+        if rec is None:
+            return "Order ID not found."
+        return rec.status
 
     def initiate_return(self, order_id: str, reason: str) -> str:
         """Initiates a return for a given order ID with a specified reason.
         Return not initiated if shipping above 10 days.
         """
-        if order_id in ["12345", "67890", "11223"]:
-            shipping_date_str = self.order_shipped.get(order_id)
-            if shipping_date_str:
-                shipping_date = datetime.datetime.strptime(
-                    shipping_date_str, "%d/%m/%y"
-                ).date()
-                days_since_shipped = (datetime.date.today() - shipping_date).days
-                if days_since_shipped > 10:
-                    return (
-                        f"Return cannot be initiated for order {order_id} as it has been"
-                        f" more than 10 days since shipping."
-                    )
-            self.order_statuses[order_id] = "Return Initiated"
-            original_price = float(self.order_price[order_id].rstrip("$"))
-            penalty = original_price * 0.02
-            new_price = original_price - penalty
-            self.order_price[order_id] = f"{new_price:.2f}$"
-            return (
-                f"Return initiated for order {order_id} due to: {reason}. Price after"
-                f" penalty is {self.order_price[order_id]}."
-            )
-        else:
+        rec = self.orders.get(order_id)
+        if rec is None:
             return "Order ID not found. Cannot initiate return."
+        if rec.status == "Return Initiated":
+            return RETURN_ALREADY_INITIATED.format(order_id=order_id)
+        days_since_shipped = (datetime.date.today() - rec.shipped).days
+        if days_since_shipped > 10:
+            return RETURN_TOO_LATE.format(order_id=order_id)
+        rec.previous_status = rec.status
+        rec.status = "Return Initiated"
+        penalty = rec.price * 0.02
+        rec.price -= penalty
+        return RETURN_OK.format(order_id=order_id, reason=reason, price=rec.price)
 
     def cancel_return(self, order_id: str, reason: str) -> str:
         """Cancel return for an order ID by stating reason - changed mind."""
-        if order_id in self.order_statuses:
-            if self.order_statuses[order_id] == "Return Initiated":
-                self.order_statuses[order_id] = self.order_statuses.get(
-                    order_id, "Cancelled Order"
-                )
-                self.order_price[order_id] = self.order_price.get(
-                    order_id, "order_price"
-                )
-                return (
-                    f"Return cancellation initiated for order {order_id} due to:"
-                    f" {reason}. Price reset to {self.order_price[order_id]}."
-                )
-            else:
-                return (
-                    f"Order {order_id} is not in 'Return Initiated' status. Cannot"
-                    " cancel return."
-                )
-        else:
+        rec = self.orders.get(order_id)
+        if rec is None:
             return "Order ID not found. Cannot cancel return."
+        if rec.status == "Return Initiated":
+            rec.status = rec.previous_status
+            rec.price = rec.original_price
+            return CANCEL_OK.format(order_id=order_id, reason=reason, price=rec.price)
+        else:
+            return CANCEL_NOT_INITIATED.format(order_id=order_id)
 
 
-# Create an instance of OrderStatusManager
-order_manager = OrderStatusManager()
+def async_tool(method):
+    """Wrap a method as a tool with a native coroutine for the async graph.
 
-# Wrap the methods as tools
-get_total_price_tool = tool(order_manager.get_total_price)
-get_order_status_tool = tool(order_manager.get_order_status)
-initiate_return_tool = tool(order_manager.initiate_return)
-cancel_return_tool = tool(order_manager.cancel_return)
+    ToolNode gathers a turn's tool calls; with a coroutine they run on the
+    event loop in call order instead of each hopping to a worker thread.
+    """
 
-# LLM and tools setup
-llm = ChatGroq(model="Llama3-8b-8192")
-tools = [
-    get_order_status_tool,
-    initiate_return_tool,
-    get_total_price_tool,
-    cancel_return_tool,
-]
-llm_with_tools = llm.bind_tools(tools)
+    async def coroutine(*args, **kwargs):
+        return method(*args, **kwargs)
 
+    return StructuredTool.from_function(func=method, coroutine=coroutine)
 
-def assistant(state: MessagesState):
-    """Use the LLM to decide the next step."""
-    return {"messages": [llm_with_tools.invoke(state["messages"])]}
 
+@st.cache_resource
+def get_event_loop():
+    """Start one background event loop for all graph runs.
 
-# Graph
-builder = StateGraph(MessagesState)
-builder.add_node("assistant", assistant)
-builder.add_node("tools", ToolNode(tools))
-builder.add_edge(START, "assistant")
-builder.add_conditional_edges("assistant", tools_condition)
-builder.add_edge("tools", "assistant")
+    The async Groq client stays tied to the loop it first ran on, so runs are
+    scheduled here instead of through a fresh asyncio.run per rerun.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+@st.cache_resource
+def build_graph():
+    """Build the order manager, tools, LLM and compiled graph once per process."""
+    # Create an instance of OrderStatusManager
+    order_manager = OrderStatusManager()
+
+    # Wrap the methods as tools
+    get_total_price_tool = async_tool(order_manager.get_total_price)
+    get_order_status_tool = async_tool(order_manager.get_order_status)
+    initiate_return_tool = async_tool(order_manager.initiate_return)
+    cancel_return_tool = async_tool(order_manager.cancel_return)
+
+    # Cache LLM responses so a conversation that repeats an earlier one (e.g.
+    # the same opening question in a new session) skips the Groq round-trip
+    set_llm_cache(InMemoryCache(maxsize=1024))
+
+    # LLM and tools setup
+    # The fast model routes to tools; the larger one answers what it can't route
+    llm_fast = ChatGroq(model="llama-3.1-8b-instant")
+    llm_big = ChatGroq(model="llama-3.3-70b-versatile")
+    tools = [
+        get_order_status_tool,
+        initiate_return_tool,
+        get_total_price_tool,
+        cancel_return_tool,
+    ]
+    # Build the tool JSON schemas once and share them between both bindings
+    tool_schemas = [convert_to_openai_tool(t) for t in tools]
+    llm_with_tools = llm_fast.bind_tools(tool_schemas)
+    llm_answer = llm_big.bind_tools(tool_schemas, tool_choice="none")
+
+    async def assistant(state: MessagesState):
+        """Use the fast LLM to decide the next step."""
+        # A first-pass reply without tool calls is only a draft for synthesize
+        first_pass = isinstance(state["messages"][-1], HumanMessage)
+        config = {"tags": ["draft"]} if first_pass else None
+        response = await llm_with_tools.ainvoke(state["messages"], config=config)
+        return {"messages": [response]}
+
+    async def synthesize(state: MessagesState):
+        """Answer with the larger LLM, replacing the fast model's draft."""
+        draft = state["messages"][-1]
+        response = await llm_answer.ainvoke(state["messages"][:-1])
+        # Copy rather than mutate: the LLM cache may hold this message object
+        response = response.model_copy(update={"id": draft.id})
+        return {"messages": [response]}
+
+    def route_assistant(state: MessagesState):
+        """Run requested tools, or escalate an unrouted question to synthesize."""
+        if tools_condition(state) == "tools":
+            return "tools"
+        if isinstance(state["messages"][-2], HumanMessage):
+            return "synthesize"
+        return END
+
+    # Graph
+    builder = StateGraph(MessagesState)
+    builder.add_node("assistant", assistant)
+    builder.add_node("tools", ToolNode(tools, handle_tool_errors=True))
+    builder.add_node("synthesize", synthesize)
+    builder.add_edge(START, "assistant")
+    builder.add_conditional_edges(
+        "assistant", route_assistant, ["tools", "synthesize", END]
+    )
+    builder.add_edge("tools", "assistant")
+    builder.add_edge("synthesize", END)
+
+    # Persist checkpoints to SQLite instead of keeping every thread in memory
+    async def open_checkpointer():
+        # One database per app script, so apps never clear each other's threads
+        db_path = pathlib.Path(__file__).with_suffix(".checkpoints.db")
+        conn = await aiosqlite.connect(db_path)
+        checkpointer = AsyncSqliteSaver(conn)
+        await checkpointer.setup()
+        # Sessions and order state end with the process, so old threads are dead
+        await conn.executescript("DELETE FROM checkpoints; DELETE FROM writes;")
+        await conn.commit()
+        return checkpointer
+
+    checkpointer = asyncio.run_coroutine_threadsafe(
+        open_checkpointer(), get_event_loop()
+    ).result()
+    graph = builder.compile(checkpointer=checkpointer)
+    return graph, order_manager
+
+
+graph, order_manager = build_graph()
+
+
+def iterate_async(aiterator):
+    """Drain an async iterator on the background loop, yielding items here."""
+    items = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in aiterator:
+                items.put(item)
+        finally:
+            items.put(done)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_event_loop())
+    try:
+        while (item := items.get()) is not done:
+            yield item
+        future.result()
+    finally:
+        # Stop the run if the consumer goes away, e.g. a rerun mid-reply
+        future.cancel()
+
+
+# Plain status/price lookups are answered without a round-trip to the LLM
+INTENT_PATTERN = re.compile(r"\b(status|price|return|cancel)\b", re.IGNORECASE)
+ORDER_ID_PATTERN = re.compile(r"\b\d{5}\b")
+
+
+def fast_reply(user_input):
+    """Answer a single status or price lookup directly, or return None."""
+    intents = {intent.lower() for intent in INTENT_PATTERN.findall(user_input)}
+    order_ids = ORDER_ID_PATTERN.findall(user_input)
+    if len(intents) != 1 or len(order_ids) != 1:
+        return None
+    intent, order_id = intents.pop(), order_ids[0]
+    if intent not in ("status", "price"):
+        return None
+    if order_id not in order_manager.orders:
+        return "Order ID not found."
+    if intent == "status":
+        status = order_manager.get_order_status(order_id)
+        return f"The status of order {order_id} is {status}."
+    price = order_manager.get_total_price(order_id)
+    return f"The total price of order {order_id} is {price}."
+
+
+def stream_reply(user_input):
+    """Yield the assistant's reply to user_input token by token."""
+    # Each browser session gets its own conversation thread
+    thread_id = st.session_state.setdefault("thread_id", str(uuid.uuid4()))
+    config = {"configurable": {"thread_id": thread_id}}
+    reply = fast_reply(user_input)
+    if reply is not None:
+        # Record the exchange so later LLM turns still see it; writing it as
+        # synthesize's output routes straight to END
+        graph.update_state(
+            config,
+            {"messages": [HumanMessage(content=user_input), AIMessage(content=reply)]},
+            as_node="synthesize",
+        )
+        yield reply
+        return
+
+    events = iterate_async(
+        graph.astream(
+            {"messages": [HumanMessage(content=user_input)]},
+            config,
+            stream_mode="messages",
+        )
+    )
+    for chunk, metadata in events:
+        if "draft" in metadata.get("tags", []):
+            continue
+        if isinstance(chunk, AIMessage) and chunk.content:
+            yield chunk.content
 
-# Initialize memory to persist state between graph runs
-checkpointer = MemorySaver()
-graph = builder.compile(checkpointer=checkpointer)
 
 # Streamlit app
 st.title("Order Status Chatbot")
@@ -130,6 +301,8 @@ st.title("Order Status Chatbot")
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
+# The chat input stays at the top level so Streamlit pins it to the bottom;
+# inside an st.fragment it would be rendered inline instead
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
@@ -139,18 +312,8 @@ if user_input := st.chat_input("Enter your message"):
     with st.chat_message("user"):
         st.markdown(user_input)
 
-    config = {"configurable": {"thread_id": "1"}}
-    events = graph.stream(
-        {"messages": [HumanMessage(content=user_input)]},
-        config,
-        stream_mode="values",
+    with st.chat_message("assistant"):
+        response_content = st.write_stream(stream_reply(user_input))
+    st.session_state.messages.append(
+        {"role": "assistant", "content": response_content}
     )
-
-    for event in events:
-        if "messages" in event:
-            response_content = event["messages"][-1].content
-            st.session_state.messages.append(
-                {"role": "assistant", "content": response_content}
-            )
-            with st.chat_message("assistant"):
-                st.markdown(response_content)